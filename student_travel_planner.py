@@ -1,9 +1,28 @@
+import io
 import os
+import re
 import json
 import time
+import queue
+import random
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import httpx
+import ijson
+import orjson
+import numpy as np
+import pandas as pd
 import streamlit as st
 import google.genai as genai
-from google.genai import types
+from google.genai import errors, types
+from pydantic import BaseModel, Field
+
+# google-genai runs its async transport on aiohttp when that package is installed, otherwise on httpx
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
 # --- Configuration and Setup ---
 
@@ -15,152 +34,564 @@ API_KEY = os.environ.get("GEMINI_API_KEY", "AIzaSyAfX5tJn6tg1323-uXUZke6-G96_1uY
 # Exponential backoff parameters for API calls
 MAX_RETRIES = 5
 INITIAL_DELAY = 1
+MAX_DELAY = 16
+
+# Client errors worth retrying (timeouts and rate limits); any other 4xx fails immediately.
+# Malformed JSON is retried once, since the model occasionally emits a truncated response.
+RETRYABLE_STATUS_CODES = {408, 429}
+MAX_JSON_RETRIES = 1
+
+# Transport-level failures (dropped connections, timeouts) that are retried for either async transport
+NETWORK_ERRORS = (httpx.TransportError, asyncio.TimeoutError, TimeoutError, ConnectionError)
+if aiohttp is not None:
+    NETWORK_ERRORS += (aiohttp.ClientError,)
+
+# How long an identical (destination, days, interests) request is served from cache
+CACHE_TTL_SECONDS = 3600
+
+# Semantic cache parameters: near-duplicate trips (same destination and length, interests with
+# cosine similarity above the threshold) reuse a previously generated itinerary instead of calling Gemini again.
+EMBEDDING_MODEL = "text-embedding-004"
+SEMANTIC_CACHE_THRESHOLD = 0.92
+
+# Optional request log (one JSON object per line). Disabled unless ITINERARY_LOG_PATH is set;
+# writes run on a background thread so they never hold up the spinner.
+REQUEST_LOG_PATH = os.environ.get("ITINERARY_LOG_PATH")
+
+# Upper bound on Gemini requests in flight across all sessions of this server process.
+# Keeps bursts under the per-minute quota instead of letting every user hit 429s and back off together.
+MAX_CONCURRENT_REQUESTS = 8
+
+# Input checks run before any Gemini call: a destination needs at least two consecutive letters
+# (any script, so non-Latin city names pass) and interests need a few real characters.
+DESTINATION_PATTERN = re.compile(r"[^\W\d_]{2,}")
+MIN_INTERESTS_LENGTH = 3
 
 # --- Structured Output Schema for the Itinerary ---
-ITINERARY_SCHEMA = types.Schema(
-    type=types.Type.ARRAY,
-    description="A list of daily itinerary plans.",
-    items=types.Schema(
-        type=types.Type.OBJECT,
-        properties={
-            "day": types.Schema(type=types.Type.INTEGER, description="The day number, starting from 1."),
-            "theme": types.Schema(type=types.Type.STRING, description="A short, catchy theme for the day (e.g., 'Historical Walking Tour', 'Cheap Eats Day')."),
-            "plan": types.Schema(
-                type=types.Type.ARRAY,
-                description="List of activities for the day.",
-                items=types.Schema(
-                    type=types.Type.OBJECT,
-                    properties={
-                        "time": types.Schema(type=types.Type.STRING, description="Time slot (e.g., 'Morning', 'Lunch', 'Afternoon', 'Evening')."),
-                        "activity": types.Schema(type=types.Type.STRING, description="The specific activity or location."),
-                        "estimated_cost_usd": types.Schema(type=types.Type.NUMBER, description="Estimated cost for the activity in USD (use 0 for free activities).")
-                    },
-                    required=["time", "activity", "estimated_cost_usd"]
-                )
-            ),
-            "efficiency_tip": types.Schema(type=types.Type.STRING, description="A practical, budget-focused tip for minimizing travel time or cost, focusing on walking/public transport.")
-        },
-        required=["day", "theme", "plan", "efficiency_tip"]
-    )
+
+def _build_itinerary_schema():
+    """Declares the itinerary as pydantic models, which google-genai accepts directly as a response_schema."""
+    # Descriptions are kept to a few words: the schema is sent as input tokens with every request.
+    class Activity(BaseModel):
+        time: str = Field(description="Time slot, e.g. Morning")
+        activity: str = Field(description="Activity or location")
+        estimated_cost_usd: float = Field(description="Cost USD, 0 if free")
+
+    class DayPlan(BaseModel):
+        day: int = Field(description="Day number from 1")
+        theme: str = Field(description="Short catchy day theme")
+        plan: list[Activity] = Field(description="Activities for the day")
+        efficiency_tip: str = Field(description="Budget walking/transit tip")
+
+    return list[DayPlan]
+
+
+SYSTEM_INSTRUCTION = (
+    "You are a World-Class Budget Student Travel Expert and Route Planner. "
+    "Your goal is to create a detailed, efficient, and fun travel plan for a student with limited funds. "
+    "All suggestions MUST prioritize free or low-cost activities (under $20 USD). "
+    "You must return the response as a valid JSON object matching the provided schema. "
+    "Provide specific cost estimates for each activity in USD. "
+    "For the 'efficiency_tip', focus on grouping nearby locations to minimize travel or suggesting budget public transport passes."
+)
+
+# The fixed instructions come first and the trip details last, so every request shares the same
+# prompt prefix (system instruction + preamble) and Gemini can reuse its cached prefill for it.
+USER_QUERY_PREFIX = (
+    "The total budget is restricted (focus on lowest costs). "
+    "Ensure the plan is efficient to follow, grouping activities by location. "
+)
+USER_QUERY_TEMPLATE = USER_QUERY_PREFIX + (
+    "Generate a {days}-day travel itinerary for a trip to {destination}. "
+    "The student is interested in: {interests}."
 )
 
 # --- Core Functionality: AI Generation ---
 
-def generate_student_itinerary(destination, days, interests):
+class ItineraryGenerationError(Exception):
+    """Raised when an itinerary could not be generated; the message is shown to the user."""
+
+
+class ItineraryFormatError(ValueError):
+    """Raised when a response parses as JSON but is not a non-empty list of day plans."""
+
+
+@st.cache_resource(show_spinner=False)
+def get_client():
     """
-    Connects to the Gemini API to generate a structured, budget-friendly itinerary.
-    Implements exponential backoff for robust API calling, providing detailed errors on failure.
+    Creates the Gemini client once per server process so every rerun, user and retry shares its connection pool.
+    The httpx transports are switched to HTTP/2 so concurrent sessions multiplex over one kept-alive connection.
+    When aiohttp is installed google-genai uses it for the async transport instead, which has no http2 option.
     """
-    if not API_KEY:
-        return "Error: GEMINI_API_KEY is missing. Please set it as an environment variable.", None
-
-    try:
-        client = genai.Client(api_key=API_KEY)
-    except Exception as e:
-        return f"Error initializing Gemini client: {e}", None
-
-    system_instruction = (
-        "You are a World-Class Budget Student Travel Expert and Route Planner. "
-        "Your goal is to create a detailed, efficient, and fun travel plan for a student with limited funds. "
-        "All suggestions MUST prioritize free or low-cost activities (under $20 USD). "
-        "You must return the response as a valid JSON object matching the provided schema. "
-        "Provide specific cost estimates for each activity in USD. "
-        "For the 'efficiency_tip', focus on grouping nearby locations to minimize travel or suggesting budget public transport passes."
+    http_options = types.HttpOptions(
+        client_args={"http2": True},
+        async_client_args={"http2": True} if aiohttp is None else None,
     )
+    return genai.Client(api_key=API_KEY, http_options=http_options)
 
-    user_query = (
-        f"Generate a {days}-day travel itinerary for a trip to {destination}. "
-        f"The total budget is restricted (focus on lowest costs). "
-        f"The student is interested in: {interests}. "
-        "Ensure the plan is efficient to follow, grouping activities by location."
-    )
 
-    generation_config = types.GenerateContentConfig(
-        system_instruction=system_instruction,
+@st.cache_resource(show_spinner=False)
+def get_generation_config():
+    """
+    Builds the request config, including the itinerary schema models, once per server process.
+    Streamlit re-executes module scope on every rerun, so it is cached as a resource.
+    """
+    return types.GenerateContentConfig(
+        system_instruction=SYSTEM_INSTRUCTION,
         response_mime_type="application/json",
-        response_schema=ITINERARY_SCHEMA,
+        response_schema=_build_itinerary_schema(),
         # Note: Tool use (Google Search) is incompatible with structured JSON output, so it has been removed.
     )
 
+
+@st.cache_resource(show_spinner=False)
+def _get_async_runtime():
+    """
+    Runs a single asyncio event loop in a daemon thread for the lifetime of the server process and returns it
+    with the semaphore that limits concurrent Gemini requests on it.
+    The async client's connection pool is bound to the loop that opened it, so all Gemini calls
+    are scheduled here instead of on a fresh asyncio.run() loop per rerun. The semaphore is created on the
+    loop thread (older Pythons bind it to the current loop on construction) and cached together with the loop
+    so the two can never be paired with different loops.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="gemini-event-loop", daemon=True).start()
+    semaphore = asyncio.run_coroutine_threadsafe(_create_request_semaphore(), loop).result()
+    return loop, semaphore
+
+
+async def _create_request_semaphore():
+    """Creates the request semaphore from inside the shared event loop."""
+    return asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+
+def _run_async(coro, updates=None, on_update=None):
+    """
+    Runs a coroutine on the shared event loop and blocks the script thread until it finishes.
+    Items the coroutine puts on the `updates` queue are passed to `on_update` from the script thread,
+    since Streamlit elements can only be drawn there.
+    """
+    loop, _ = _get_async_runtime()
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    if updates is not None:
+        while not future.done() or not updates.empty():
+            try:
+                on_update(updates.get(timeout=0.1))
+            except queue.Empty:
+                pass
+    return future.result()
+
+
+async def _generate_once(client, semaphore, user_query, generation_config, updates=None):
+    """
+    Streams a single Gemini request and parses each day plan as soon as its JSON object closes.
+    The partial itinerary is pushed onto `updates` after every completed day, so Day 1 can be shown
+    while later days are still being generated. The full response is only parsed as a fallback.
+    A slot on `semaphore` is held while the request is in flight (but not during retry backoff).
+    """
+    buffer = io.StringIO()
+    parsed_days = ijson.sendable_list()
+    parser = ijson.items_coro(parsed_days, 'item', use_float=True)
+    itinerary = []
+    streaming_ok = True
+
+    async with semaphore:
+        stream = await client.aio.models.generate_content_stream(
+            model='gemini-2.5-flash',
+            contents=[user_query],
+            config=generation_config,
+        )
+        async for chunk in stream:
+            if not chunk.text:
+                continue
+            buffer.write(chunk.text)
+            if not streaming_ok:
+                continue
+
+            try:
+                parser.send(chunk.text.encode())
+            except ijson.JSONError:
+                streaming_ok = False
+                continue
+
+            if parsed_days:
+                itinerary.extend(parsed_days)
+                del parsed_days[:]
+                if updates is not None:
+                    updates.put(list(itinerary))
+
+    if streaming_ok:
+        try:
+            parser.close()
+        except ijson.JSONError:
+            streaming_ok = False
+
+    if streaming_ok and itinerary:
+        return itinerary
+
+    # Incremental parsing failed (or found no days), so parse the complete response instead
+    itinerary = orjson.loads(buffer.getvalue())
+    if not isinstance(itinerary, list) or not itinerary:
+        raise ItineraryFormatError(f"Expected a non-empty list of day plans, got {buffer.getvalue()[:100]!r}")
+    return itinerary
+
+
+async def _generate_with_retries(client, semaphore, user_query, generation_config, updates=None):
+    """
+    Retries _generate_once with jittered, capped exponential backoff, raising ItineraryGenerationError when exhausted.
+    Only rate limits, server errors and network failures are retried; errors that cannot succeed on a retry
+    (bad requests, authentication, repeated malformed JSON) fail fast.
+    """
     last_error = "Unknown error occurred before first API call."
-    
+    json_failures = 0
+
     for attempt in range(MAX_RETRIES):
         try:
-            # print(f"Attempting to generate itinerary (Attempt {attempt + 1})...")
-            response = client.models.generate_content(
-                model='gemini-2.5-flash',
-                contents=[user_query],
-                config=generation_config,
-            )
-
-            # Successfully received response, now try to parse it
-            try:
-                itinerary_json = json.loads(response.text)
-                return "Itinerary generated successfully!", itinerary_json
-            except json.JSONDecodeError as e:
-                # Store error for AI generation failure
-                last_error = f"AI response format error (Day {attempt+1}): Failed to parse JSON response. Details: {e}"
-                
-        except Exception as e:
-            # Store error for connection/authentication/rate limit failure
+            return await _generate_once(client, semaphore, user_query, generation_config, updates)
+        except (json.JSONDecodeError, orjson.JSONDecodeError, ItineraryFormatError) as e:
+            # Store error for AI generation failure
+            last_error = f"AI response format error (Day {attempt+1}): Invalid itinerary JSON. Details: {e}"
+            json_failures += 1
+            if json_failures > MAX_JSON_RETRIES:
+                raise ItineraryGenerationError(f"Failed to generate itinerary. Last known error: {last_error}")
+        except errors.ServerError as e:
+            last_error = f"Gemini API server error (Day {attempt+1}): {e}"
+        except errors.ClientError as e:
+            if e.code not in RETRYABLE_STATUS_CODES:
+                raise ItineraryGenerationError(f"Gemini API rejected the request: {e}")
+            last_error = f"Gemini API rate limit or timeout (Day {attempt+1}): {e}"
+        except NETWORK_ERRORS as e:
+            # Store error for connection failure
             last_error = f"Gemini API connection error (Day {attempt+1}): {e}"
+        except Exception as e:
+            raise ItineraryGenerationError(f"Gemini API error: {e}")
 
-        # Exponential Backoff
+        # Exponential Backoff, with jitter so concurrent users don't retry in lockstep
         if attempt < MAX_RETRIES - 1:
-            delay = INITIAL_DELAY * (2 ** attempt)
-            time.sleep(delay)
-            # Suppress detailed console logging for clean Streamlit output
+            delay = min(INITIAL_DELAY * (2 ** attempt) + random.random(), MAX_DELAY)
+            await asyncio.sleep(delay)
+
+    # Final error after all retries have failed
+    raise ItineraryGenerationError(f"Failed to generate itinerary after multiple retries. Last known error: {last_error}")
+
+
+@st.cache_resource(show_spinner=False)
+def _get_itinerary_cache():
+    """
+    Process-wide exact-match cache mapping normalized (destination, days, interests) to (created_at, itinerary_json),
+    returned with the lock that guards it since every session thread shares the dict.
+    A plain dict is used instead of st.cache_data because the streamed preview draws into a placeholder
+    created outside the generating function, which st.cache_data cannot record for replay.
+    """
+    return {}, threading.Lock()
+
 
-    # Final return after all retries have failed
-    return f"Failed to generate itinerary after multiple retries. Last known error: {last_error}", None
+def _cache_get(key):
+    """Returns the cached itinerary for `key`, or None if it is missing or older than CACHE_TTL_SECONDS."""
+    cache, lock = _get_itinerary_cache()
+    with lock:
+        entry = cache.get(key)
+    if entry is None or time.monotonic() - entry[0] > CACHE_TTL_SECONDS:
+        return None
+    return entry[1]
+
+
+def _cache_put(key, itinerary_json):
+    """Stores a successfully generated itinerary, dropping any entries that have expired."""
+    cache, lock = _get_itinerary_cache()
+    now = time.monotonic()
+    with lock:
+        for stale_key in [k for k, (created_at, _) in cache.items() if now - created_at > CACHE_TTL_SECONDS]:
+            del cache[stale_key]
+        cache[key] = (now, itinerary_json)
+
+
+def _fetch_itinerary(destination, days, interests, on_progress=None):
+    """
+    Connects to the Gemini API to generate a structured, budget-friendly itinerary.
+    The request runs on the shared event loop with exponential backoff, providing detailed errors on failure.
+    If given, `on_progress` is called with the partial itinerary each time another day has streamed in.
+    """
+    try:
+        client = get_client()
+    except Exception as e:
+        raise ItineraryGenerationError(f"Error initializing Gemini client: {e}")
+
+    user_query = USER_QUERY_TEMPLATE.format(days=days, destination=destination, interests=interests)
+
+    generation_config = get_generation_config()
+
+    updates = queue.Queue() if on_progress else None
+    _, semaphore = _get_async_runtime()
+    coro = _generate_with_retries(client, semaphore, user_query, generation_config, updates)
+    return _run_async(coro, updates, on_progress)
+
+
+def _embed_interests(client, interests):
+    """Embeds a trip's interests, L2-normalized so dot products are cosine similarities."""
+    response = client.models.embed_content(model=EMBEDDING_MODEL, contents=interests)
+    embedding = np.asarray(response.embeddings[0].values, dtype=np.float32)
+    return embedding / np.linalg.norm(embedding)
+
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def _embed_query_interests(interests):
+    """Embeds the interests of an incoming request once per unique input."""
+    return _embed_interests(get_client(), interests)
+
+
+@st.cache_resource(show_spinner=False)
+def _get_embedding_pool():
+    """Creates the worker thread that embeds stored trips, so storing never holds up the spinner."""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="itinerary-embed")
+
+
+def semantic_lookup(destination, days, interests):
+    """
+    Returns (cached_itinerary, query_embedding) for a near-duplicate trip; either may be None. Destination and days
+    must match exactly, so only the interests are compared by embedding; rows whose embedding is still pending or
+    failed are skipped. The interests are only embedded when there is a candidate row to compare against.
+    """
+    rows = [
+        row for (row_destination, _, _), row in st.session_state.get("sem_cache", {}).items()
+        if row_destination == destination and row[1] == days and row[0].done() and row[0].exception() is None
+    ]
+    if not rows:
+        return None, None
+
+    query_embedding = _embed_query_interests(interests)
+    similarities = np.dot(np.vstack([row[0].result() for row in rows]), query_embedding)
+    best = int(np.argmax(similarities))
+    if similarities[best] > SEMANTIC_CACHE_THRESHOLD:
+        return rows[best][2], query_embedding
+    return None, query_embedding
+
+
+def semantic_store(destination, days, interests, itinerary_json, embedding=None):
+    """
+    Records a generated itinerary as an (embedding_future, days, itinerary_json) row for semantic_lookup.
+    An embedding already computed by semantic_lookup is reused; otherwise it is computed on a background
+    thread, so the result reaches the UI without waiting for it.
+    """
+    if embedding is not None:
+        embedding_future = Future()
+        embedding_future.set_result(embedding)
+    else:
+        embedding_future = _get_embedding_pool().submit(_embed_interests, get_client(), interests)
+    sem_cache = st.session_state.setdefault("sem_cache", {})
+    sem_cache[(destination, days, interests)] = (embedding_future, days, itinerary_json)
+
+
+@st.cache_resource(show_spinner=False)
+def _get_log_pool():
+    """Creates the request-logging worker threads once per server process so they survive reruns."""
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="itinerary-log")
+
+
+def _write_log(destination, days, latency_ms, status):
+    """Appends one JSON line describing a finished request to REQUEST_LOG_PATH."""
+    record = {
+        "timestamp": time.time(),
+        "destination": destination,
+        "days": days,
+        "latency_ms": round(latency_ms),
+        "status": status,
+    }
+    with open(REQUEST_LOG_PATH, "a", encoding="utf-8") as log_file:
+        log_file.write(json.dumps(record) + "\n")
+
+
+def generate_student_itinerary(destination, days, interests, on_progress=None, use_cache=True):
+    """
+    Returns a (status_message, itinerary_json) tuple for the requested trip.
+    Inputs are normalized first so that e.g. "Rome" and "rome " are served from the same cache entry.
+    `on_progress` receives partial itineraries while a fresh one is streamed from Gemini.
+    With `use_cache=False` the caches are skipped for lookup (but still updated) to force a new itinerary.
+    """
+    if not API_KEY:
+        return "Error: GEMINI_API_KEY is missing. Please set it as an environment variable.", None
+
+    destination = destination.strip().lower()
+    interests = interests.strip().lower()
+
+    started = time.perf_counter()
+    status_message, itinerary_json = _resolve_itinerary(destination, days, interests, on_progress, use_cache)
+    if REQUEST_LOG_PATH:
+        # Logging is handed to the background pool so the result reaches the UI without waiting on file I/O
+        latency_ms = (time.perf_counter() - started) * 1000
+        _get_log_pool().submit(_write_log, destination, days, latency_ms, status_message)
+
+    return status_message, itinerary_json
+
+
+def _resolve_itinerary(destination, days, interests, on_progress, use_cache):
+    """Serves normalized inputs from the exact or semantic cache when possible, otherwise asks Gemini."""
+    cache_key = (destination, days, interests)
+    query_embedding = None
+
+    if use_cache:
+        cached_itinerary = _cache_get(cache_key)
+        if cached_itinerary is not None:
+            return "Itinerary generated successfully!", cached_itinerary
+
+        # The semantic cache is best-effort: embedding failures fall through to a normal request.
+        try:
+            cached_itinerary, query_embedding = semantic_lookup(destination, days, interests)
+        except Exception:
+            cached_itinerary = None
+        if cached_itinerary is not None:
+            return "Itinerary generated successfully! (Reused a similar trip from your session.)", cached_itinerary
+
+    try:
+        itinerary_json = _fetch_itinerary(destination, days, interests, on_progress)
+    except ItineraryGenerationError as e:
+        return str(e), None
+
+    _cache_put(cache_key, itinerary_json)
+
+    try:
+        semantic_store(destination, days, interests, itinerary_json, query_embedding)
+    except Exception:
+        pass
+
+    return "Itinerary generated successfully!", itinerary_json
+
+
+async def _generate_many(client, semaphore, user_queries, generation_config):
+    """Runs one retrying request per query concurrently on the shared client, returning results or errors in order."""
+    return await asyncio.gather(
+        *[_generate_with_retries(client, semaphore, user_query, generation_config) for user_query in user_queries],
+        return_exceptions=True,
+    )
+
+
+def generate_many(trip_requests):
+    """
+    Generates itineraries for several (destination, days, interests) variants at once, e.g. to compare
+    a 3-day and a 5-day trip. Requests missing from the cache are dispatched concurrently, so the wait is
+    the slowest request rather than the sum. Returns a (status_message, itinerary_json) tuple per request, in order.
+    """
+    if not API_KEY:
+        return [("Error: GEMINI_API_KEY is missing. Please set it as an environment variable.", None)] * len(trip_requests)
+
+    cache_keys = [(destination.strip().lower(), days, interests.strip().lower()) for destination, days, interests in trip_requests]
+    results = {key: _cache_get(key) for key in cache_keys}
+    misses = [key for key, itinerary_json in results.items() if itinerary_json is None]
+
+    if misses:
+        try:
+            client = get_client()
+        except Exception as e:
+            return [(f"Error initializing Gemini client: {e}", None)] * len(trip_requests)
+
+        user_queries = [
+            USER_QUERY_TEMPLATE.format(days=days, destination=destination, interests=interests)
+            for destination, days, interests in misses
+        ]
+        _, semaphore = _get_async_runtime()
+        coro = _generate_many(client, semaphore, user_queries, get_generation_config())
+        for key, result in zip(misses, _run_async(coro)):
+            # gather() can also return BaseExceptions such as CancelledError, which must not be cached
+            if not isinstance(result, BaseException):
+                _cache_put(key, result)
+            results[key] = result
+
+    return [
+        (str(results[key]) or f"Failed to generate itinerary: {type(results[key]).__name__}", None)
+        if isinstance(results[key], BaseException) else ("Itinerary generated successfully!", results[key])
+        for key in cache_keys
+    ]
 
 # --- Display Utility (Streamlit specific) ---
 
+def _markdown_cell(value):
+    """
+    Escapes model-generated text for Streamlit Markdown: pipes and newlines would break a table row,
+    and pairs of dollar signs would be rendered as LaTeX.
+    """
+    return str(value).replace("|", "\\|").replace("$", "\\$").replace("\n", " ")
+
+
 def display_itinerary_streamlit(itinerary):
     """Renders the structured itinerary using Streamlit components."""
     if not itinerary:
         return
 
-    total_cost = sum(
-        sum(activity.get("estimated_cost_usd", 0) for activity in day_plan.get("plan", []))
-        for day_plan in itinerary
+    # Flatten every activity once so costs are aggregated in pandas rather than with nested Python sums.
+    # Rows are keyed by the day's position, so days with a missing or repeated "day" number stay separate.
+    activities_df = pd.DataFrame(
+        [
+            {"day": index, "cost": activity.get("estimated_cost_usd", 0)}
+            for index, day_plan in enumerate(itinerary)
+            for activity in day_plan.get("plan", [])
+        ],
+        columns=["day", "cost"],
     )
+    total_cost = activities_df["cost"].sum()
+    daily_costs = activities_df.groupby("day")["cost"].sum().to_dict()
 
     st.header("✨ Your Personalized Travel Itinerary")
     st.markdown(f"**Total Estimated Cost (Activities Only):** **${total_cost:.2f}**")
     st.markdown("_Note: This excludes flights, accommodation, and general food._")
 
-    for day_plan in itinerary:
+    for index, day_plan in enumerate(itinerary):
         day_num = day_plan.get("day", "N/A")
         theme = day_plan.get("theme", "No Theme")
         plan = day_plan.get("plan", [])
         tip = day_plan.get("efficiency_tip", "No tip provided.")
 
-        daily_cost = sum(activity.get("estimated_cost_usd", 0) for activity in plan)
+        daily_cost = daily_costs.get(index, 0)
 
         with st.expander(f"📅 Day {day_num}: {theme} (Cost: ${daily_cost:.2f})", expanded=True):
-            
-            # Display activities in a clean table format
-            activities_data = [
-                {
-                    "Time": activity.get("time", "N/A"),
-                    "Activity": activity.get("activity", "N/A"),
-                    "Cost (USD)": f"${activity.get('estimated_cost_usd', 0):.2f}"
-                }
+
+            # Activities table and tip are sent as a single Markdown element to keep per-day messages to a minimum.
+            rows = "\n".join(
+                f"| {_markdown_cell(activity.get('time', 'N/A'))} "
+                f"| {_markdown_cell(activity.get('activity', 'N/A'))} "
+                f"| \\${activity.get('estimated_cost_usd', 0):.2f} |"
                 for activity in plan
-            ]
-            st.table(activities_data)
+            )
+            st.markdown(
+                "| Time | Activity | Cost (USD) |\n|---|---|---|\n"
+                f"{rows}\n\n"
+                f"> **🚌 Efficiency Tip:** {_markdown_cell(tip)}"
+            )
 
-            st.info(f"**🚌 Efficiency Tip:** {tip}")
+
+@st.fragment
+def _render_itinerary():
+    """
+    Renders the result stored in session state. The fragment decorator is groundwork: the region has no
+    widgets yet, so every rerun still comes from the form or Regenerate button outside it. Controls added
+    here later (e.g. filters on the results) would rerun only this fragment instead of the whole script.
+    """
+    status_message = st.session_state.get("status")
+    if not status_message:
+        return
+
+    if "successfully" in status_message:
+        st.success(status_message)
+        display_itinerary_streamlit(st.session_state["itinerary"])
+    else:
+        # Display the more detailed error message
+        st.error(status_message)
 
 # --- Main Streamlit App Logic ---
 
+def _request_regenerate():
+    """Button callback: flags the next run of main to generate a fresh itinerary."""
+    st.session_state["regenerate_requested"] = True
+
+
 def main():
-    st.set_page_config(
-        page_title="AI Student Travel Planner",
-        layout="wide",
-        initial_sidebar_state="expanded"
-    )
+    # Page config only needs to reach the browser once per session; skip it on later reruns
+    if "page_configured" not in st.session_state:
+        st.set_page_config(
+            page_title="AI Student Travel Planner",
+            layout="wide",
+            initial_sidebar_state="expanded"
+        )
+        st.session_state["page_configured"] = True
 
     st.title("✈️ AI Student Travel Planner")
     st.markdown("### Personalized, Budget-Friendly Itineraries Powered by Gemini")
@@ -180,28 +611,50 @@ def main():
                                  help="E.g., history, cheap food, local markets, photography", 
                                  key="interests")
         
-        submitted = st.form_submit_button("Generate Budget Itinerary")
+        submitted = st.form_submit_button("Generate Budget Itinerary", key="submit")
+
+    # Regenerating reuses the last submitted form values but asks Gemini for a brand-new plan
+    regenerate = st.session_state.pop("regenerate_requested", False)
 
-    if submitted:
-        if not all([destination, days, interests]):
-            st.warning("Please fill in all the required fields.")
+    if submitted or regenerate:
+        if not DESTINATION_PATTERN.search(destination):
+            st.warning("Please enter a valid destination (e.g., Rome, Italy).")
             return
+        if len(interests.strip()) < MIN_INTERESTS_LENGTH:
+            st.warning(f"Please describe your interests (at least {MIN_INTERESTS_LENGTH} characters).")
+            return
+
+        if regenerate:
+            st.session_state.pop("itinerary", None)
+
+        # Days are rendered here as they stream in, then replaced by the final itinerary
+        preview = st.empty()
+
+        def show_partial_itinerary(partial_itinerary):
+            with preview.container():
+                display_itinerary_streamlit(partial_itinerary)
 
         with st.spinner("🧠 Generating your optimized itinerary... This may take a moment."):
             # 2. Generate Itinerary
             status_message, itinerary_data = generate_student_itinerary(
                 destination=destination,
                 days=days,
-                interests=interests
+                interests=interests,
+                on_progress=show_partial_itinerary,
+                use_cache=not regenerate
             )
+        preview.empty()
+
+        # Keep the result in session state so UI-only reruns render it without calling Gemini again
+        st.session_state["status"] = status_message
+        st.session_state["itinerary"] = itinerary_data
+
+    # 3. Display Results
+    _render_itinerary()
 
-        # 3. Display Results
-        if "successfully" in status_message:
-            st.success(status_message)
-            display_itinerary_streamlit(itinerary_data)
-        else:
-            # Display the more detailed error message
-            st.error(status_message)
+    # Drawn after the result is stored so it is available as soon as the first itinerary appears
+    if st.session_state.get("itinerary"):
+        st.button("🔄 Regenerate Itinerary", key="regenerate", on_click=_request_regenerate)
 
 
 if __name__ == "__main__":